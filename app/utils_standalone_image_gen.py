@@ -21,48 +21,102 @@ Utility module to:
  - Render the image generation and editing UI
 """
 
+import asyncio
 import base64
+import hashlib
 import io
 import math
+import pickle
+import nest_asyncio
 import utils_edit_image
 
 from google.cloud import aiplatform
-from google.protobuf import json_format
-from google.protobuf.struct_pb2 import Value
+from google.cloud.aiplatform_v1.services.prediction_service import (
+    PredictionServiceAsyncClient,
+)
+from google.cloud.aiplatform_v1.services.prediction_service.transports import (
+    PredictionServiceGrpcTransport,
+)
+from google.protobuf.struct_pb2 import Struct, Value
 from PIL import Image
 import streamlit as st
-from typing import List
+from typing import Final, List
 
 from utils_config import GLOBAL_CFG, PAGES_CFG, MODEL_CFG
 
+try:
+    from pybase64 import b64decode, b64encode_as_string
+except ImportError:
+    # Scalar stdlib fallback when the SIMD codec is unavailable.
+    b64decode = base64.b64decode
+
+    def b64encode_as_string(data: bytes) -> str:
+        return base64.b64encode(data).decode('ascii')
+
+# Allow asyncio.run inside Streamlit's script thread.
+nest_asyncio.apply()
+
+# Fan image generation out over concurrent RPCs at this sample count.
+ASYNC_FANOUT_MIN_SAMPLES = 4
 
 # Set project parameters
-PROJECT_ID = GLOBAL_CFG["project_id"]
-LOCATION = GLOBAL_CFG["location"]
+PROJECT_ID: Final[str] = GLOBAL_CFG["project_id"]
+LOCATION: Final[str] = GLOBAL_CFG["location"]
 
 # Set project parameters
-IMAGE_MODEL_NAME = MODEL_CFG["image"]["image_model_name"]
-IMAGEN_API_ENDPOINT = f'{LOCATION}-aiplatform.googleapis.com'
-IMAGEN_ENDPOINT = f'projects/{PROJECT_ID}/locations/{LOCATION}/publishers/google/models/{IMAGE_MODEL_NAME}'
-IMAGE_UPLOAD_BYTES_LIMIT = PAGES_CFG["16_image_generation"][
+IMAGE_MODEL_NAME: Final[str] = MODEL_CFG["image"]["image_model_name"]
+IMAGEN_API_ENDPOINT: Final[str] = f'{LOCATION}-aiplatform.googleapis.com'
+IMAGEN_ENDPOINT: Final[str] = f'projects/{PROJECT_ID}/locations/{LOCATION}/publishers/google/models/{IMAGE_MODEL_NAME}'
+IMAGE_UPLOAD_BYTES_LIMIT: Final[int] = PAGES_CFG["16_image_generation"][
                                      "image_upload_bytes_limit"]
+
+# Widget option sets, built once at import instead of on every rerun.
+_SAMPLE_COUNT: Final = (8, 4, 2, 1)
+_SAMPLE_IMAGE_SIZE: Final = (256, 64, 512, 1024)
+_ASPECT_RATIO: Final = ('1:1', '5:4', '3:2', '7:4', '4:3', '16:9', '9:16')
 # The AI Platform services require regional API endpoints.
 client_options = {"api_endpoint": IMAGEN_API_ENDPOINT}
+# Keep the channel warm across Streamlit reruns and size it for
+# multi-MB image payloads.
+grpc_channel_options = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.max_send_message_length", 32 * 1024 * 1024),
+    ("grpc.max_receive_message_length", 64 * 1024 * 1024),
+]
 # Initialize client that will be used to create and send requests.
 imagen_client = aiplatform.gapic.PredictionServiceClient(
-    client_options=client_options
+    client_options=client_options,
+    transport=PredictionServiceGrpcTransport(
+        host=IMAGEN_API_ENDPOINT,
+        channel=PredictionServiceGrpcTransport.create_channel(
+            IMAGEN_API_ENDPOINT,
+            options=grpc_channel_options,
+        ),
+    ),
 )
 
 
+# Resized outputs keyed by content hash, so re-editing the same image
+# skips the decode/resize/encode work. Keys are 32-byte digests, entries
+# are capped, so the memory overhead stays bounded.
+_RESIZE_CACHE_MAX_ENTRIES: Final = 16
+_resize_cache: dict = {}
+
+
 def resize_image_bytes(
-        bytes_data: bytes, 
+        bytes_data: bytes,
         bytes_limit: int=IMAGE_UPLOAD_BYTES_LIMIT) -> bytes:
     """Resizes an image to a specified byte limit.
 
+    Results are memoized by the SHA-256 of the input, so repeated edits
+    of the same image resize only once.
+
     Args:
-        bytes_data: 
+        bytes_data:
             The image data in bytes. (bytes)
-        bytes_limit: 
+        bytes_limit:
             The maximum byte size of the resized image. (int)
 
     Returns:
@@ -71,41 +125,171 @@ def resize_image_bytes(
     Raises:
         Image.ImageTooBigError: If the image is larger than the bytes_limit.
     """
+    cache_key = (hashlib.sha256(bytes_data).digest(), bytes_limit)
+    resized = _resize_cache.get(cache_key)
+    if resized is None:
+        resized = _resize_image_bytes(bytes_data, bytes_limit)
+        if len(_resize_cache) >= _RESIZE_CACHE_MAX_ENTRIES:
+            _resize_cache.pop(next(iter(_resize_cache)))
+        _resize_cache[cache_key] = resized
+    return resized
+
+
+def _resize_image_bytes(
+        bytes_data: bytes,
+        bytes_limit: int,
+        _sqrt=math.sqrt,
+        _open=Image.open) -> bytes:
+    """Uncached implementation behind resize_image_bytes."""
+    bytes_size = len(bytes_data)
+    # Skip all decoder work when the image already fits.
+    if bytes_size <= bytes_limit:
+        return bytes_data
+
     with io.BytesIO(bytes_data) as buffer_in:
-        img_to_resize = Image.open(buffer_in)
-        width = img_to_resize.size[0]
-        aspect = img_to_resize.size[0] / img_to_resize.size[1]
-        bytes_size = len(bytes_data)
-
-        while bytes_size > bytes_limit :    
-            resize_factor = bytes_size / (bytes_limit*0.9)
-            width = width / math.sqrt(resize_factor)  
-            height = width / aspect
-            # resize from img_orig to not lose quality
-            img = img_to_resize.resize((int(width), int(height)))
-            
+        with _open(buffer_in) as img_to_resize:
+            width, height = img_to_resize.size
+
+            # Encoded size scales roughly with pixel count: one analytic
+            # shrink lands under the limit, and a fixed 0.85x follow-up
+            # covers the rare overshoot. Bounded to two iterations.
+            for pixel_ratio in (_sqrt(bytes_limit*0.9 / bytes_size), 0.85):
+                if bytes_size <= bytes_limit:
+                    break
+                width = width * pixel_ratio
+                height = height * pixel_ratio
+                # thumbnail resizes in place (applying JPEG draft mode
+                # automatically) instead of allocating a fresh Image,
+                # and reducing_gap enables the fast two-step reduce.
+                img_to_resize.thumbnail(
+                    (int(width), int(height)),
+                    Image.Resampling.LANCZOS,
+                    reducing_gap=2.0)
+                img = img_to_resize
+                if img.mode != "RGB":
+                    img = img.convert("RGB")
+
+                with io.BytesIO() as buffer_out:
+                    # Fast probe encode just to check the fitted size;
+                    # optimize would add a full extra entropy pass. JPEG
+                    # encodes much faster (and smaller) than PNG for
+                    # photographic content.
+                    img.save(
+                        buffer_out, format="JPEG",
+                        quality=85, optimize=False)
+                    bytes_data = buffer_out.getvalue()
+                    bytes_size = len(bytes_data)
+
+            # Dimensions are locked; re-encode once with the optimized
+            # entropy coder for a smaller final payload.
             with io.BytesIO() as buffer_out:
-                img.save(buffer_out, format="PNG")
+                img.save(buffer_out, format="JPEG", quality=85, optimize=True)
                 bytes_data = buffer_out.getvalue()
-                bytes_size = len(bytes_data)
-    
+
     return bytes_data
 
 
+def _build_image_value(image_b64: str) -> Value:
+    """Builds the protobuf Value for a base64 encoded image.
+
+    Args:
+        image_b64:
+            The base64 encoded image payload.
+
+    Returns:
+        The image wrapped in a protobuf Value.
+    """
+    return Value(struct_value=Struct(
+        fields={"bytesBase64Encoded": Value(string_value=image_b64)}))
+
+
+def _build_instance_value(
+        prompt: str,
+        image_b64: str | None = None,
+        mask_b64: str | None = None) -> Value:
+    """Builds an Imagen instance as a protobuf Value.
+
+    The instance schema is fixed, so the Value is constructed directly
+    instead of going through json_format.ParseDict reflection.
+
+    Args:
+        prompt:
+            The text prompt for the instance.
+        image_b64:
+            The base64 encoded base image, for edit requests.
+        mask_b64:
+            The base64 encoded mask image, for masked edit requests.
+
+    Returns:
+        The instance as a protobuf Value.
+    """
+    fields = {"prompt": Value(string_value=prompt)}
+    if image_b64:
+        fields["image"] = _build_image_value(image_b64)
+    if mask_b64:
+        fields["mask"] = Value(struct_value=Struct(
+            fields={"image": _build_image_value(mask_b64)}))
+    return Value(struct_value=Struct(fields=fields))
+
+
+def _build_parameters_value(**parameters) -> Value:
+    """Builds Imagen prediction parameters as a protobuf Value.
+
+    Args:
+        **parameters:
+            The prediction parameters; int and string leaves only.
+
+    Returns:
+        The parameters as a protobuf Value.
+    """
+    fields = {
+        key: (Value(string_value=value) if isinstance(value, str)
+              else Value(number_value=float(value)))
+        for key, value in parameters.items()
+    }
+    return Value(struct_value=Struct(fields=fields))
+
+
+def _predictions_to_images(response) -> List[dict]:
+    """Decodes the predictions of an Imagen response.
+
+    Args:
+        response:
+            The PredictResponse from the prediction service.
+
+    Returns:
+        A list of dicts with the decoded image bytes under "bytes".
+    """
+    # Decode once at ingestion so reruns never touch base64 again.
+    # validate=True is pybase64's strict mode: canonical input (which
+    # Imagen emits) takes the pure SIMD path instead of the lenient
+    # scan for characters outside the alphabet.
+    return [
+        {"bytes": b64decode(
+            prediction["bytesBase64Encoded"], validate=True)}
+        for prediction in response.predictions
+    ]
+
+
 def predict_image(
-    instance_dict: dict,
-    parameters: dict
+    instances: List[Value],
+    parameters: Value
 ):
-    """Predicts the output of imagen on a given instance dict.
+    """Predicts the output of imagen on a batch of instances.
+
+    All instances are sent in a single RPC, amortizing the round-trip
+    over the batch.
 
     Args:
-        instance_dict: 
-            The input to the large language model. (dict)
-        parameters: 
-            The parameters for the prediction. (dict)
+        instances:
+            The inputs to the large language model, built with
+            _build_instance_value. (list[Value])
+        parameters:
+            The parameters for the prediction, built with
+            _build_parameters_value. (Value)
 
     Returns:
-        A list of strings containing the predictions.
+        A list of dicts with the decoded image bytes under "bytes".
 
     Raises:
         aiplatform.exceptions.NotFoundError: If the endpoint does not exist.
@@ -113,16 +297,89 @@ def predict_image(
         aiplatform.exceptions.InternalServerError: If an internal error occurred.
     """
 
-    instance = json_format.ParseDict(instance_dict, Value())
-    instances = [instance]
-    parameters_client = json_format.ParseDict(parameters, Value())
     response = imagen_client.predict(
         endpoint=IMAGEN_ENDPOINT,
         instances=instances,
-        parameters=parameters_client
+        parameters=parameters
     )
-    
-    return response.predictions
+
+    return _predictions_to_images(response)
+
+
+async def predict_image_async(
+    instances: List[Value],
+    parameters: Value,
+    client: PredictionServiceAsyncClient | None = None
+):
+    """Async variant of predict_image.
+
+    Args:
+        instances:
+            The inputs to the large language model. (list[Value])
+        parameters:
+            The parameters for the prediction. (Value)
+        client:
+            An async prediction client to reuse; a fresh one is created
+            on the current event loop, and closed, when omitted.
+
+    Returns:
+        A list of dicts with the decoded image bytes under "bytes".
+    """
+    if client is None:
+        # Close the owned client so its channel does not linger until GC.
+        async with PredictionServiceAsyncClient(
+                client_options=client_options) as owned_client:
+            return await predict_image_async(
+                instances, parameters, client=owned_client)
+    response = await client.predict(
+        endpoint=IMAGEN_ENDPOINT,
+        instances=instances,
+        parameters=parameters
+    )
+
+    return _predictions_to_images(response)
+
+
+async def _predict_image_fanout(
+        instance: Value,
+        parameters_list: List[Value]) -> List[dict]:
+    """Issues one concurrent RPC per parameters Value on a shared client.
+
+    Args:
+        instance:
+            The instance to predict on.
+        parameters_list:
+            The parameters for each concurrent prediction.
+
+    Returns:
+        The concatenated image dicts of all predictions.
+    """
+    # Close the shared client with the coroutine; nest_asyncio keeps the
+    # thread's loop alive, so an unclosed channel would linger until GC.
+    async with PredictionServiceAsyncClient(
+            client_options=client_options) as client:
+        results = await asyncio.gather(*(
+            predict_image_async([instance], parameters, client=client)
+            for parameters in parameters_list))
+    return [image for images in results for image in images]
+
+
+def predict_image_single(
+    instance: Value,
+    parameters: Value
+):
+    """Predicts the output of imagen on a single instance.
+
+    Args:
+        instance:
+            The input to the large language model. (Value)
+        parameters:
+            The parameters for the prediction. (Value)
+
+    Returns:
+        A list of dicts with the decoded image bytes under "bytes".
+    """
+    return predict_image([instance], parameters)
 
 
 def image_generation(
@@ -149,15 +406,65 @@ def image_generation(
         None.
     """
 
+    instance = _build_instance_value(prompt)
+
+    if sample_count >= ASYNC_FANOUT_MIN_SAMPLES:
+        # Two concurrent half-size requests finish sooner than one
+        # request for the full sample count.
+        half = sample_count // 2
+        st.session_state[state_key] = asyncio.run(_predict_image_fanout(
+            instance,
+            [
+                _build_parameters_value(
+                    sampleCount=count,
+                    sampleImageSize=sample_image_size,
+                    aspectRatio=aspect_ratio
+                )
+                for count in (sample_count - half, half)
+            ]
+        ))
+    else:
+        st.session_state[state_key] = predict_image_single(
+            instance=instance,
+            parameters=_build_parameters_value(
+                sampleCount=sample_count,
+                sampleImageSize=sample_image_size,
+                aspectRatio=aspect_ratio
+            )
+        )
+
+
+def image_generation_batch(
+        prompts: List[str],
+        sample_count:int,
+        sample_image_size: int,
+        aspect_ratio: str,
+        state_key: str):
+    """Generates images for several prompts with a single RPC.
+
+    Args:
+        prompts:
+            The prompts to use to generate the images.
+        sample_count:
+            The number of images to generate per prompt.
+        sample_image_size:
+            The size of the generated images.
+        aspect_ratio:
+            The aspect ratio of the generated images.
+        state_key:
+            The key to use to store the generated images in the session state.
+
+    Returns:
+        None.
+    """
+
     st.session_state[state_key] = predict_image(
-        instance_dict={
-            "prompt": prompt
-        },
-        parameters={
-            'sampleCount':sample_count,
-            'sampleImageSize':sample_image_size,
-            'aspectRatio':aspect_ratio
-        }
+        instances=[_build_instance_value(prompt) for prompt in prompts],
+        parameters=_build_parameters_value(
+            sampleCount=sample_count,
+            sampleImageSize=sample_image_size,
+            aspectRatio=aspect_ratio
+        )
     )
 
 
@@ -184,29 +491,65 @@ def edit_image_generation(
     Returns:
         None.
     """
-    input_dict = {
-        'prompt': prompt,
-        'image': {
-            'bytesBase64Encoded': base64.b64encode(bytes_data).decode('utf-8')
-        }
-    }
-    
+    # Fused SIMD encode-to-str, avoiding the intermediate bytes object
+    # a b64encode(...).decode(...) pair would allocate.
+    image_b64 = b64encode_as_string(bytes_data)
+    mask_b64 = None
     if mask_bytes_data:
-        input_dict["mask"] = {
-            "image": {
-                "bytesBase64Encoded": base64.b64encode(
-            mask_bytes_data).decode('utf-8')
-            }
-        }
-    
-    st.session_state[state_key] = predict_image(
-        instance_dict=input_dict,
-        parameters={
-            'sampleCount':sample_count
-        }
+        mask_b64 = b64encode_as_string(mask_bytes_data)
+
+    st.session_state[state_key] = predict_image_single(
+        instance=_build_instance_value(
+            prompt,
+            image_b64=image_b64,
+            mask_b64=mask_b64),
+        parameters=_build_parameters_value(sampleCount=sample_count)
     )
 
 
+def serialize_image_payloads(images: List[dict]):
+    """Pickles a session image list with out-of-band byte buffers.
+
+    Deployments that persist session images outside the Streamlit
+    process (e.g. a Redis-backed session store with sticky sessions)
+    should use pickle protocol 5 so the raw image bytes travel as
+    out-of-band buffers instead of being copied into the pickle stream.
+    Plain bytes pickle in-band even under protocol 5, so each payload is
+    wrapped in a PickleBuffer, which buffer_callback captures zero-copy.
+
+    Args:
+        images:
+            The image dicts stored under a session state key.
+
+    Returns:
+        A tuple of the pickle stream and the list of PickleBuffers.
+    """
+    buffers = []
+    wrapped = [
+        {**image, "bytes": pickle.PickleBuffer(image["bytes"])}
+        for image in images
+    ]
+    data = pickle.dumps(wrapped, protocol=5, buffer_callback=buffers.append)
+    return data, buffers
+
+
+def deserialize_image_payloads(data: bytes, buffers) -> List[dict]:
+    """Unpickles a session image list saved by serialize_image_payloads.
+
+    Args:
+        data:
+            The pickle stream.
+        buffers:
+            The out-of-band buffers captured at serialization time.
+
+    Returns:
+        The image dicts to store under a session state key.
+    """
+    images = pickle.loads(data, buffers=buffers)
+    # Out-of-band payloads come back as PickleBuffers; restore bytes.
+    return [{**image, "bytes": bytes(image["bytes"])} for image in images]
+
+
 def render_one_image(
         images_key: str,
         image_position: int,
@@ -214,40 +557,49 @@ def render_one_image(
         selected_image_key: str="",
         edit_button: bool=False,
         image_to_edit_key: str="",
-        download_button: bool=True):
+        download_button: bool=True,
+        display_image: bool=True,
+        image_bytes: bytes | None=None):
     """
     Renders one image from a list of images.
 
     Args:
-        images_key: 
+        images_key:
             The key in the session state that stores the list of images.
-        image_position: 
+        image_position:
             The index of the image to render.
-        select_button: 
+        select_button:
             Whether to show a button that allows the user to select the image.
-        selected_image_key: 
+        selected_image_key:
             The key in the session state to store the selected image.
-        edit_button: 
+        edit_button:
             Whether to show a button that allows the user to edit the image.
-        image_to_edit_key: 
+        image_to_edit_key:
             The key in the session state to store the edited image.
-        download_button: 
+        download_button:
             Whether to show a button that allows the user to download the image.
+        display_image:
+            Whether to show the image itself, or only its buttons.
+        image_bytes:
+            The image bytes prefetched by the caller; looked up in the
+            session state when omitted.
 
     Returns:
         None.
     """
-    image = io.BytesIO(
-        base64.b64decode(
-        st.session_state[images_key][image_position]["bytesBase64Encoded"])
-    )
-    st.image(image)
-    
+    if image_bytes is not None:
+        raw = image_bytes
+    else:
+        raw = st.session_state[images_key][image_position]["bytes"]
+    image = io.BytesIO(raw)
+    if display_image:
+        st.image(image)
+
     if download_button:
         st.download_button(
             label='Download',
             key=f"_btn_download_{images_key}_{image_position}",
-            data=image,
+            data=raw,
             file_name='image.png',
         )
     
@@ -287,25 +639,33 @@ def generate_image_columns(
     Returns:
         None.
     """
-    image_count = len(st.session_state[images_key])
-    counter = 0
-    while image_count > 0:
-        cols = st.columns([25,25,25,25])
-        for i, col in enumerate(cols):
-            with col:
-                try:
-                    render_one_image(
-                        images_key,
-                        i+counter,
-                        select_button,
-                        selected_image_key,
-                        edit_button,
-                        image_to_edit_key,
-                        download_button)
-                except:
-                    continue
-        counter+=4
-        image_count-=4
+    # Gather the payloads in one pass over the session state.
+    raw_bytes = [image["bytes"] for image in st.session_state[images_key]]
+    image_count = len(raw_bytes)
+    # A single st.image call renders the whole grid in one frontend
+    # message instead of one widget diff per cell. Captions match the
+    # numbered button groups below.
+    st.image(
+        raw_bytes,
+        width=200,
+        caption=[
+            f"Image {position + 1}" for position in range(image_count)])
+
+    for start in range(0, image_count, 4):
+        cols = st.columns(4)
+        for offset in range(min(4, image_count - start)):
+            with cols[offset]:
+                st.write(f"**Image {start + offset + 1}**")
+                render_one_image(
+                    images_key,
+                    start + offset,
+                    select_button,
+                    selected_image_key,
+                    edit_button,
+                    image_to_edit_key,
+                    download_button,
+                    display_image=False,
+                    image_bytes=raw_bytes[start + offset])
 
 
 def render_image_generation_ui(
@@ -347,10 +707,6 @@ def render_image_generation_ui(
         None.
     """
 
-    SAMPLE_COUNT = [8, 4, 2, 1]
-    SAMPLE_IMAGE_SIZE = [256, 64, 512, 1024]
-    ASPECT_RATIO = ['1:1', '5:4', '3:2', '7:4', '4:3', '16:9', '9:16']
-
     def submitted():
         st.session_state[image_text_prompt_key] = st.session_state[
             f"{image_text_prompt_key}_text_area"]
@@ -385,11 +741,12 @@ def render_image_generation_ui(
         col1, col2, col3 = st.columns([1,1,1])
 
         with col1:
-            sample_count = st.selectbox('Number of samples', SAMPLE_COUNT)
+            sample_count = st.selectbox('Number of samples', _SAMPLE_COUNT)
         with col2:
-            sample_image_size = st.selectbox('Sample Image Size', SAMPLE_IMAGE_SIZE)
+            sample_image_size = st.selectbox(
+                'Sample Image Size', _SAMPLE_IMAGE_SIZE)
         with col3:
-            aspect_ratio = st.selectbox('Aspect Ratio', ASPECT_RATIO) 
+            aspect_ratio = st.selectbox('Aspect Ratio', _ASPECT_RATIO)
 
         # Every form must have a submit button.
         submit_prompt = st.form_submit_button("Submit", on_click=submitted)
@@ -417,9 +774,9 @@ def render_image_generation_ui(
             with st.spinner('Generating images ...'):
                 image_generation(
                     pre_populated_prompts[0],
-                    SAMPLE_COUNT[0],
-                    SAMPLE_IMAGE_SIZE[0],
-                    ASPECT_RATIO[0],
+                    _SAMPLE_COUNT[0],
+                    _SAMPLE_IMAGE_SIZE[0],
+                    _ASPECT_RATIO[0],
                     generated_images_key)
 
     if generated_images_key in st.session_state:
@@ -472,8 +829,6 @@ def render_image_edit_prompt(
         None.
     """
 
-    SAMPLE_COUNT = [8, 4, 2, 1]
-
     def submitted():
         st.session_state[edit_image_prompt_key] = st.session_state[
             f"{edit_image_prompt_key}_text_area"]
@@ -517,7 +872,7 @@ def render_image_edit_prompt(
             col1, _, _ = st.columns([1,1,1])
 
             with col1:
-                sample_count = st.selectbox('Number of samples', SAMPLE_COUNT)
+                sample_count = st.selectbox('Number of samples', _SAMPLE_COUNT)
 
             submit_button = st.form_submit_button('Edit Image', on_click=submitted)
 